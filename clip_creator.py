@@ -1,19 +1,177 @@
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
 import os
+import csv
+import struct
 import neo.rawio
 from neo.io import MicromedIO
 from pathlib import Path
-from micromed_io.trc import MicromedTRC
 from shutil import copyfile
+from src.trc_header import read_fixed_header, iter_trc_files, prefetch_headers
+from concurrent.futures import ThreadPoolExecutor
 
+HEADER_CACHE_FNAME = "header_cache.parquet"
+HEADER_CACHE_PARTIAL_FNAME = "header_cache.partial.csv"
+# Cache entry of the files that are not valid .trc files, so that they are not parsed again on every run
+INVALID_HEADER = {'sampling_frequency': 0, 'recording_date': None, 'number_of_channels': 0, 'n_samples': 0}
+HEADER_CACHE_COLUMNS = ['filepath', 'mtime_ns', 'size', 'sampling_frequency', 'recording_date', 'number_of_channels', 'n_samples']
+RECORDING_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
 
-def get_valid_directories(data_path:Path, data_out_path:Path):
+
+def _probe_header(fpath:Path):
+    """
+    Read the header information of a .trc file.
+    Args:
+        fpath (Path): Path to the .trc file.
+    Returns:
+        dict: Header information, INVALID_HEADER if the file is not a valid .trc file, None if the file can't be read.
+    """
+    try:
+        return read_fixed_header(fpath)
+    except (ValueError, struct.error) as e:
+        print(f"Error reading file: {fpath} ({e})")
+        return INVALID_HEADER
+    except OSError as e:
+        # Files that can't be read now, e.g. locked by the acquisition software, are read again on the next run
+        print(f"Error reading file: {fpath} ({e})")
+    return None
+
+
+def _trim_partial_cache(partial_fpath:Path):
+    """
+    Remove the last row of the partial cache file if the run was interrupted while writing it,
+    i.e. if the file does not end with a line terminator.
+    Args:
+        partial_fpath (Path): Path to the partial cache file.
+    Returns:
+        int: Size of the partial cache file after trimming.
+    """
+    with open(partial_fpath, 'rb+') as f:
+        content = f.read()
+        if not content.endswith(b'\n'):
+            f.truncate(content.rfind(b'\n') + 1)
+        return f.seek(0, os.SEEK_END)
+
+
+def _load_or_build_header_cache(data_out_path:Path):
+    """
+    Load the cached header information of the already parsed .trc files, including the headers
+    saved to the partial cache file by a run that was interrupted.
+    Args:
+        data_out_path (Path): Path to the directory containing the cache file.
+    Returns:
+        dict: Cached header information, by file path.
+    """
+    cache_fpath = data_out_path / HEADER_CACHE_FNAME
+    partial_fpath = data_out_path / HEADER_CACHE_PARTIAL_FNAME
+
+    cache_df = pd.DataFrame(columns=HEADER_CACHE_COLUMNS)
+    if cache_fpath.is_file():
+        cache_df = pd.read_parquet(cache_fpath, engine='pyarrow')
+
+    if partial_fpath.is_file() and _trim_partial_cache(partial_fpath) > 0:
+        print(f"Resuming from {partial_fpath}")
+        int_columns = ['mtime_ns', 'size', 'sampling_frequency', 'number_of_channels', 'n_samples']
+        partial_df = pd.read_csv(partial_fpath)
+        partial_df = partial_df.astype({column: 'int64' for column in int_columns})
+        partial_df['recording_date'] = pd.to_datetime(partial_df['recording_date'], format=RECORDING_DATE_FORMAT, errors='coerce')
+        if cache_df.empty:
+            cache_df = partial_df
+        else:
+            cache_df = pd.concat([cache_df, partial_df], ignore_index=True)
+
+    return {header['filepath']: header for header in cache_df.to_dict('records')}
+
+
+def _save_header_cache(header_cache:dict, data_out_path:Path):
+    """
+    Save the header cache if headers were parsed since it was last saved, i.e. if the partial cache file
+    has rows, the partial cache file is only removed once the cache is complete.
+    Args:
+        header_cache (dict): Cached header information, by file path.
+        data_out_path (Path): Path to the directory containing the cache file.
+    """
+    partial_fpath = data_out_path / HEADER_CACHE_PARTIAL_FNAME
+    if not partial_fpath.is_file():
+        return
+
+    with open(partial_fpath, 'r', newline='') as partial_file:
+        nr_partial_rows = sum(1 for _ in partial_file) - 1
+    if nr_partial_rows > 0:
+        cache_fpath = data_out_path / HEADER_CACHE_FNAME
+        cache_df = pd.DataFrame(list(header_cache.values()), columns=HEADER_CACHE_COLUMNS)
+        cache_df.to_parquet(cache_fpath.with_suffix('.tmp'), engine='pyarrow', compression='zstd', index=False)
+        os.replace(cache_fpath.with_suffix('.tmp'), cache_fpath)
+    os.remove(partial_fpath)
+
+
+def _read_headers(fpaths, header_cache:dict, data_out_path:Path):
+    """
+    Read the header information of .trc files, only the files that are new or were modified
+    since the last run are parsed, the rest is taken from the header cache. Files that are not valid
+    .trc files are cached as well, with a sampling frequency of 0, files that can't be read are not cached.
+    Args:
+        fpaths (iterable): Paths to the .trc files, consumed as the files are parsed.
+        header_cache (dict): Cached header information, by file path, updated with the parsed headers.
+        data_out_path (Path): Path to the directory containing the cache file.
+    Returns:
+        tuple: List of file paths and list of their header information, None for the files that can't be read.
+    """
+    read_fpaths = []
+    headers = []
+    to_parse_idx = []
+
+    def _cache_misses():
+        # Look up every file in the cache and only hand the missing ones to the parser
+        for fpath in fpaths:
+            # Files that disappear or can't be read after being listed are skipped
+            try:
+                st = os.stat(fpath)
+            except OSError as e:
+                print(f"Error reading file: {fpath} ({e})")
+                continue
+            header = header_cache.get(str(fpath))
+            cache_hit = header is not None and header['mtime_ns'] == st.st_mtime_ns and header['size'] == st.st_size
+            if not cache_hit:
+                header = {'filepath': str(fpath), 'mtime_ns': st.st_mtime_ns, 'size': st.st_size}
+                to_parse_idx.append(len(headers))
+            read_fpaths.append(fpath)
+            headers.append(header if not cache_hit or header['sampling_frequency'] > 0 else None)
+            if not cache_hit:
+                yield fpath
+
+    # Parse the missing headers in parallel while the files are still being listed,
+    # each parsed header is saved right away to the partial cache file so that an interrupted run can be resumed
+    partial_fpath = data_out_path / HEADER_CACHE_PARTIAL_FNAME
+    with ThreadPoolExecutor() as executor, open(partial_fpath, 'a', newline='') as partial_file:
+        partial_writer = csv.DictWriter(partial_file, fieldnames=HEADER_CACHE_COLUMNS)
+        if partial_file.tell() == 0:
+            partial_writer.writeheader()
+        probed_headers = executor.map(_probe_header, prefetch_headers(_cache_misses()))
+        for i, probed_header in zip(to_parse_idx, probed_headers):
+            if probed_header is None:
+                headers[i] = None
+                continue
+            header = headers[i]
+            header.update(probed_header)
+            header_cache[header['filepath']] = header
+            partial_writer.writerow(header)
+            partial_file.flush()
+            if probed_header is INVALID_HEADER:
+                headers[i] = None
+
+    return read_fpaths, headers
+
+
+def get_valid_directories(data_path:Path, data_out_path:Path, header_cache:dict):
     """
     Get the list of valid directories containing .trc files with a sampling frequency greater than 1000 Hz.
     Args:
         data_path (Path): Path to the directory containing .trc files.
         data_out_path (Path): Path to save the output CSV file.
+        header_cache (dict): Cached header information of the .trc files, by file path.
     Returns:
         pd.DataFrame: DataFrame containing the valid directories.
     """
@@ -25,22 +183,13 @@ def get_valid_directories(data_path:Path, data_out_path:Path):
     if file_out_path.is_file():
         valid_dirs_df = pd.read_csv(file_out_path)
     else:
-        # Get the list of all .trc files in the directory and its subdirectories
-        files_to_copy = list(data_path.glob("**/*.trc"))
-        files_to_copy_sorted = np.sort(files_to_copy)
-
-        for i, fpath in enumerate(files_to_copy_sorted):
-            print(f"Processing file {i+1}/{len(files_to_copy_sorted)}: {fpath}")
-            try:
-                mmtrc = MicromedTRC(fpath)
-                sfreq = mmtrc.get_sfreq()
-                recording_date = mmtrc.get_header().recording_date
-                if sfreq > 1000:
-                    directories_ls.append(fpath.parent)
-            except:
-                print(f"Error reading file: {fpath}")
-                continue
-        valid_directories_ls = np.unique(directories_ls).tolist()
+        # Read all .trc files in the directory and its subdirectories as they are found
+        files_to_copy, headers = _read_headers(iter_trc_files(data_path), header_cache, data_out_path)
+        for i, (fpath, header) in enumerate(zip(files_to_copy, headers)):
+            print(f"Processing file {i+1}/{len(files_to_copy)}: {fpath}")
+            if header is not None and header['sampling_frequency'] > 1000:
+                directories_ls.append(fpath.parent)
+        valid_directories_ls = sorted({str(parent_dir) for parent_dir in directories_ls})
         print(f"Number of valid directories: {len(valid_directories_ls)}")
         # Save the list of valid directories to a CSV file
         valid_dirs_df = pd.DataFrame(valid_directories_ls, columns=['Valid_Directories'])
@@ -50,75 +199,65 @@ def get_valid_directories(data_path:Path, data_out_path:Path):
     return valid_dirs_df
 
 
-def get_valid_files_info(data_path:Path, data_out_path:Path):
+def get_valid_files_info(data_path:Path, data_out_path:Path, header_cache:dict):
 
     nr_valid_files = 0
 
-    # DIctionary to store the file information
-    files_info = {
-        'directory': [],
-        'filepath': [],
-        'filename': [],
-        'recording_date': [],
-        'sampling_frequency': [],
-        'duration_h': [],
-        'number_of_channels': [],
-        'day': []
-    }
-
-    # Get the list of all .trc files in the directory and its subdirectories
-    files_to_copy = list(data_path.glob("*.trc"))
-    files_to_copy_sorted = np.sort(files_to_copy)
-
-    for i, fpath in enumerate(files_to_copy_sorted):
-        try:
-            mmtrc = MicromedTRC(fpath)
-            sfreq = mmtrc.get_sfreq()
-            recording_date = mmtrc.get_header().recording_date
-            if sfreq > 1000:
-                ch_name = mmtrc.get_header().ch_names[0]
-                test_sig = mmtrc.get_data(picks=[ch_name])
-                duration_h = test_sig.shape[1] / sfreq / 3600
-                n_channels = mmtrc.get_header().nb_of_channels
-                print(f"Directory: {fpath.parent}")
-                print(f"File {i+1}/{len(files_to_copy_sorted)}")
-                print(f"Filename: {fpath}")
-                print(f"Recording date: {recording_date}")
-                print(f"Sampling frequency: {sfreq}")
-                print(f"Duration (h): {duration_h:.2f}")
-                print(f"Number of channels: {n_channels}")
-                print(f"Progress: {nr_valid_files/len(files_to_copy_sorted)*100:.2f}%")
-                print("\n")
-                nr_valid_files += 1
-
-                # Append the file information to the dictionary
-                files_info['directory'].append(fpath.parent)
-                files_info['filepath'].append(fpath)
-                files_info['filename'].append(fpath.name)
-                files_info['recording_date'].append(recording_date)
-                files_info['sampling_frequency'].append(sfreq)
-                files_info['duration_h'].append(duration_h)
-                files_info['number_of_channels'].append(n_channels)
-                files_info['day'].append(recording_date.day)
-                pass
-            else:
-                print(f"File {fpath} has a sampling frequency of {sfreq} Hz, skipping...")
-                continue
-        except:
-            print(f"Error reading file: {fpath}")
+    # Read all .trc files in the directory as they are found
+    files_to_copy, headers = _read_headers(iter_trc_files(data_path, recursive=False), header_cache, data_out_path)
+
+    # Arrays to store the file information, sized for the case where all files are valid
+    nr_files = len(files_to_copy)
+    filepaths = np.empty(nr_files, dtype=object)
+    recording_dates = np.empty(nr_files, dtype='datetime64[s]')
+    sfreqs = np.empty(nr_files, dtype=np.int32)
+    durations_h = np.empty(nr_files, dtype=np.float64)
+    nr_channels = np.empty(nr_files, dtype=np.int32)
+
+    for i, (fpath, header) in enumerate(zip(files_to_copy, headers)):
+        if header is None:
             continue
+        sfreq = header['sampling_frequency']
+        if sfreq > 1000:
+            recording_date = header['recording_date']
+            duration_h = header['n_samples'] / sfreq / 3600
+            n_channels = header['number_of_channels']
+            print(f"Directory: {fpath.parent}")
+            print(f"File {i+1}/{len(files_to_copy)}")
+            print(f"Filename: {fpath}")
+            print(f"Recording date: {recording_date}")
+            print(f"Sampling frequency: {sfreq}")
+            print(f"Duration (h): {duration_h:.2f}")
+            print(f"Number of channels: {n_channels}")
+            print(f"Progress: {nr_valid_files/len(files_to_copy)*100:.2f}%")
+            print("\n")
 
-    # Create a DataFrame from the dictionary
-    files_info_df = pd.DataFrame(files_info)
+            # Store the file information
+            filepaths[nr_valid_files] = str(fpath)
+            recording_dates[nr_valid_files] = np.datetime64(recording_date, 's')
+            sfreqs[nr_valid_files] = sfreq
+            durations_h[nr_valid_files] = duration_h
+            nr_channels[nr_valid_files] = n_channels
+            nr_valid_files += 1
+        else:
+            print(f"File {fpath} has a sampling frequency of {sfreq} Hz, skipping...")
+
+    # Create a DataFrame from the filled part of the arrays,
+    # the directory and filename are not stored since they can be recomputed from the filepath
+    files_info_df = pd.DataFrame({
+        'filepath': pd.array(filepaths[:nr_valid_files], dtype='string[pyarrow]'),
+        'recording_date': recording_dates[:nr_valid_files],
+        'sampling_frequency': sfreqs[:nr_valid_files],
+        'duration_h': durations_h[:nr_valid_files],
+        'number_of_channels': nr_channels[:nr_valid_files]
+    })
     files_info_df = files_info_df.sort_values('recording_date').reset_index(drop=True)
-    # Convert the recording date to a datetime object
-    files_info_df['recording_date'] = files_info_df['recording_date'].apply(pd.to_datetime)
 
     # get the day for each file with respect to the earliest date
     # Get the earliest recording date
     earliest_date = files_info_df['recording_date'].min()
     # Calculate the day for each file with respect to the earliest date
-    files_info_df['day'] = [(pd.to_datetime(record_date)-earliest_date).days for record_date in files_info_df.recording_date]
+    files_info_df['day'] = (files_info_df['recording_date'] - earliest_date).dt.days
         
     return files_info_df
 
@@ -130,22 +269,29 @@ if __name__ == "__main__":
     # Create the output directory if it doesn't exist
     os.makedirs(data_out_path, exist_ok=True)
 
+    # Load the header cache once, it is shared by all the directories and saved at the end
+    header_cache = _load_or_build_header_cache(data_out_path)
+
     # Call the function to get valid directories
     # and save the output to a CSV file
-    valid_dirs_df = get_valid_directories(data_path=data_path, data_out_path=data_out_path)
+    valid_dirs_df = get_valid_directories(data_path=data_path, data_out_path=data_out_path, header_cache=header_cache)
     
-    files_info_df = pd.DataFrame()
+    files_info_frames = []
     for i, row in valid_dirs_df.iterrows():
         
         data_path = Path(row['Valid_Directories'])
         print(f"Processing directory: {data_path}, {i+1}/{len(valid_dirs_df)}")
 
         # Call the function to get valid files information
-        this_files_info_df = get_valid_files_info(data_path=data_path, data_out_path=data_out_path)
-        # Append the DataFrame to the main DataFrame
-        files_info_df = pd.concat([files_info_df, this_files_info_df], ignore_index=True)
+        this_files_info_df = get_valid_files_info(data_path=data_path, data_out_path=data_out_path, header_cache=header_cache)
+        # Keep the DataFrame, all of them are concatenated once at the end
+        files_info_frames.append(this_files_info_df)
         print("\n\n")
 
+    files_info_df = pd.concat(files_info_frames, ignore_index=True) if files_info_frames else pd.DataFrame()
+    _save_header_cache(header_cache, data_out_path)
+
     # Save the files information DataFrame to a CSV file
-    files_info_df.to_csv(data_out_path / "USB_Stick_files_info.csv", index=False)
+    files_info_table = pa.Table.from_pandas(files_info_df, preserve_index=False)
+    pacsv.write_csv(files_info_table, str(data_out_path / "USB_Stick_files_info.csv"))
     print(f"Files information saved to {data_out_path / 'USB_Stick_files_info.csv'}")
@@ -1,70 +1,91 @@
 import numpy as np
 import pandas as pd
 import os
+import struct
 import mne
 import neo.rawio
 from neo.io import MicromedIO
 from pathlib import Path
-from micromed_io.trc import MicromedTRC
 from shutil import copyfile
+from trc_header import read_fixed_header, iter_trc_files, prefetch_headers
+from concurrent.futures import ThreadPoolExecutor
+
+
+def _probe_file_info(path:Path):
+    """
+    Read the header information of a .trc file.
+    Args:
+        path (Path): Path to the .trc file.
+    Returns:
+        tuple: Path, subject name, sampling frequency and header information of the file, None if the file can't be read.
+    """
+    try:
+        hdr = read_fixed_header(path)
+    except (OSError, ValueError, struct.error) as e:
+        print(f"Error reading file: {path} ({e})")
+        return None
+    return path, path.parts[-2], hdr['sampling_frequency'], hdr
 
 
 def copy_selecetd_files(data_path:str=None, data_out_path:str=None):
 
-    nr_valid_files = 0
-    files_to_copy = list(data_path.glob("**/*.trc"))
-    files_to_copy_sorted = [str(fname) for fname in files_to_copy]
-    files_to_copy_sorted.sort()
-    for path in files_to_copy_sorted:
-        try:
-            mmtrc = MicromedTRC(path)
-            sfreq = mmtrc.get_sfreq()
-            recording_date = mmtrc.get_header().recording_date
+    # Read the headers of all files once, only the valid files are kept for copying.
+    # The headers are read in parallel and printed here in the listing order, so that the output of the threads is not mixed
+    valid_files = []
+    with ThreadPoolExecutor() as executor:
+        for file_info in executor.map(_probe_file_info, prefetch_headers(iter_trc_files(data_path))):
+            if file_info is None:
+                continue
+            path, subj_name, sfreq, hdr = file_info
             if sfreq > 1000:
-                ch_name = mmtrc.get_header().ch_names[0]
-                test_sig = mmtrc.get_data(picks=[ch_name])
-                duration_h = test_sig.shape[1] / sfreq / 3600
-                n_channels = mmtrc.get_header().nb_of_channels
+                duration_h = hdr['n_samples'] / sfreq / 3600
                 print(f"\nFilename: {path}")
-                print(f"Recording date: {recording_date}")
+                print(f"Recording date: {hdr['recording_date']}")
                 print(f"Sampling frequency: {sfreq}")
                 print(f"Duration (h): {duration_h:.2f}")
-                print(f"Number of channels: {n_channels}")
-                nr_valid_files += 1
-        except:
-            print(f"Error reading file: {path}")
-            continue
-    
-    files_to_copy = list(data_path.glob("**/*.trc"))
+                print(f"Number of channels: {hdr['number_of_channels']}")
+                valid_files.append(file_info)
+            else:
+                print(f"{subj_name} {path.parts[-1]} --- sfreq= {sfreq}")
+    nr_valid_files = len(valid_files)
+
     files_dict = {'PatName': [], 'Filepath': []}
     processed_files_nr = 0
-    files_to_copy = files_to_copy
-    for path in files_to_copy:
+    copy_jobs = []
+    for path, subj_name, sfreq, _ in valid_files:
+        fname = path.parts[-1]
+        files_dict['PatName'].append(fname)
+        files_dict['Filepath'].append(path)
+
+        print(f"{subj_name} {fname} --- sfreq= {sfreq}")
+        new_fn = f"{subj_name}_{fname}"
+
+        os.makedirs(data_out_path, exist_ok=True)
+        new_fpath = data_out_path / new_fn
+        new_fpath = Path(str(new_fpath).replace(" ", "_"))
         try:
-            subj_name = path.parts[-2]
-            fname = path.parts[-1]
-            group = path.parts[-4]
-            files_dict['PatName'].append(fname)
-            files_dict['Filepath'].append(path)
-            mmtrc = MicromedTRC(path)
-            sfreq = mmtrc.get_sfreq()
-
-            print(f"{subj_name} {fname} --- sfreq= {sfreq}")
-            if sfreq > 1000:
-                new_fn = f"{subj_name}_{fname}"
-
-                os.makedirs(data_out_path, exist_ok=True)
-                new_fpath = data_out_path / new_fn
-                new_fpath = Path(str(new_fpath).replace(" ", "_"))
-                if not os.path.isfile(new_fpath):
-                    copyfile(path, new_fpath)
-                
-                processed_files_nr += 1
-                print(f"Progress: {processed_files_nr/nr_valid_files*100:.2f}%")
-        except:
-            print(f"Error reading file: {path}")
+            src_st = os.stat(path)
+        except OSError as e:
+            print(f"Error reading file: {path} ({e})")
             continue
-        pass
+        # Files left incomplete by an interrupted copy are copied again
+        if not os.path.isfile(new_fpath) or os.path.getsize(new_fpath) != src_st.st_size:
+            copy_jobs.append((src_st.st_ino, path, new_fpath))
+        else:
+            processed_files_nr += 1
+
+    # Copy the files one at a time in inode order, so that the source disk is mostly read sequentially
+    copy_jobs.sort(key=lambda job: job[0])
+    for _, path, new_fpath in copy_jobs:
+        try:
+            copyfile(path, new_fpath)
+            if os.path.getsize(new_fpath) != os.path.getsize(path):
+                raise OSError("incomplete copy")
+        except OSError as e:
+            print(f"Error copying file: {path} ({e})")
+            continue
+        processed_files_nr += 1
+        print(f"Progress: {processed_files_nr/nr_valid_files*100:.2f}%")
     pass
 
 if __name__ == "__main__":
@@ -79,26 +100,29 @@ if __name__ == "__main__":
         print(f"File {files_info_fpath} already exists, loading it...")
         files_info_df = pd.read_csv(files_info_fpath)
 
-        dir_ls = files_info_df.directory.str.replace(os.sep, '-').to_numpy()
-        pats_ls = np.unique(dir_ls)
+        # The directory and filename are recomputed from the filepath if the CSV doesn't store them,
+        # both Windows and POSIX separators are accepted since the CSV may come from another system
+        if 'directory' not in files_info_df.columns:
+            files_info_df['directory'] = files_info_df['filepath'].str.replace(r'[\\/][^\\/]*$', '', regex=True)
+        if 'filename' not in files_info_df.columns:
+            files_info_df['filename'] = files_info_df['filepath'].str.extract(r'([^\\/]*)$', expand=False)
+        files_info_df = files_info_df[['directory', 'filepath', 'filename', 'recording_date', 'sampling_frequency', 'duration_h', 'number_of_channels', 'day']]
+        pat_keys = files_info_df.directory.str.replace(os.sep, '-')
 
-        clae_files_df = pd.DataFrame()
+        clae_files_ls = []
 
         # select a file from the third day of each patient, if it doesn't exist, select the last file
-        for pat_dir in pats_ls:
+        for pat_dir, pat_files_info in files_info_df.groupby(pat_keys):
             pat_name = Path(pat_dir.replace("-", os.sep)).name
             print(f"Processing patient: {pat_name}")
 
-            # Select the files from the patient being processed
-            pat_sel = np.array(dir_ls) == np.array([pat_dir])
-            pat_files_info = files_info_df[pat_sel].reset_index(drop=True).copy()
+            # Files from the patient being processed
+            pat_files_info = pat_files_info.reset_index(drop=True)
 
             # Select the files from the third or last day of the patient being processed
-            day_to_select = 3
-            if pat_files_info['day'].max() < day_to_select:
-                day_to_select = pat_files_info['day'].max()
+            day_to_select = min(3, pat_files_info['day'].max())
 
-            files_sel = np.logical_and(pat_files_info['day'] == day_to_select, pat_files_info['duration_h'] > 4)
+            files_sel = (pat_files_info['day'] == day_to_select) & (pat_files_info['duration_h'] > 4)
             pat_selected_day_files_info = pat_files_info[files_sel].reset_index(drop=True).copy()
 
             # Select a random file from the last day of the patient being processed
@@ -108,11 +132,13 @@ if __name__ == "__main__":
                 else:
                     random_pat_file_info = pat_selected_day_files_info.copy()
 
-                clae_files_df = pd.concat([clae_files_df, random_pat_file_info], ignore_index=True)
+                clae_files_ls.append(random_pat_file_info)
             else:
                 print(f"No files found for patient {pat_name} on day {day_to_select}")
                 pass
             pass
+
+        clae_files_df = pd.concat(clae_files_ls, ignore_index=True) if clae_files_ls else pd.DataFrame()
         pass
     else:
         print(f"File {files_info_fpath} does not exist")
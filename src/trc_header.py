@@ -0,0 +1,109 @@
+import os
+import struct
+from pathlib import Path
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# The fixed part of the TRC header ends with the header type byte
+MIN_TRC_HEADER_BYTES = 176
+TRC_HEADER_TYPES = (0, 1, 2, 3, 4)
+TRC_RECORDING_DATE_OFFSET = 128
+TRC_DATA_ADDRESS_OFFSET = 138
+SCAN_WORKERS = 4
+
+
+def read_fixed_header(fpath:Path):
+    """
+    Read the sampling frequency, recording date and data layout of a .trc file from the fixed part of its header
+    (same offsets as micromed_io), without parsing the rest of the header.
+    Args:
+        fpath (Path): Path to the .trc file.
+    Returns:
+        dict: Sampling frequency, recording date, number of channels and number of samples per channel.
+    Raises:
+        ValueError: If the file is not a TRC file.
+    """
+    with open(fpath, 'rb') as f:
+        fixed_header = f.read(MIN_TRC_HEADER_BYTES)
+        file_size = os.fstat(f.fileno()).st_size
+    if len(fixed_header) < MIN_TRC_HEADER_BYTES or fixed_header[MIN_TRC_HEADER_BYTES - 1] not in TRC_HEADER_TYPES:
+        raise ValueError("not a TRC file")
+
+    day, month, year, hour, minute, sec = struct.unpack_from('<6B', fixed_header, TRC_RECORDING_DATE_OFFSET)
+    data_address, n_channels, _, sfreq, n_bytes = struct.unpack_from('<IHHHH', fixed_header, TRC_DATA_ADDRESS_OFFSET)
+    if n_channels == 0 or n_bytes == 0:
+        raise ValueError("no channels in TRC header")
+    return {
+        'sampling_frequency': sfreq,
+        'recording_date': datetime(year + 1900, month, day, hour, minute, sec),
+        'number_of_channels': n_channels,
+        # A file truncated before its data address has no samples
+        'n_samples': max(0, (file_size - data_address) // (n_channels * n_bytes))
+    }
+
+
+def prefetch_headers(fpaths):
+    """
+    Pass the .trc files through while asking the OS to start reading the fixed header of each file,
+    so that the read is already in flight when the file is parsed. Only the paths are passed through
+    where posix_fadvise is not available (e.g. Windows).
+    Args:
+        fpaths (iterable): Paths to the .trc files.
+    Yields:
+        Path: Path to a .trc file.
+    """
+    for fpath in fpaths:
+        if hasattr(os, 'posix_fadvise'):
+            try:
+                fd = os.open(fpath, os.O_RDONLY)
+                try:
+                    os.posix_fadvise(fd, 0, MIN_TRC_HEADER_BYTES, os.POSIX_FADV_WILLNEED)
+                finally:
+                    os.close(fd)
+            except OSError:
+                pass
+        yield fpath
+
+
+def scan_directory(dir_path:str):
+    """
+    List the .trc files and the subdirectories of a directory, hidden and system entries are skipped.
+    Args:
+        dir_path (str): Path to the directory.
+    Returns:
+        tuple: List of .trc file paths and list of subdirectory paths.
+    """
+    trc_files = []
+    sub_dirs = []
+    try:
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                if entry.name.startswith(('.', '$')):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    sub_dirs.append(entry.path)
+                elif entry.name.lower().endswith('.trc') and entry.is_file():
+                    trc_files.append(Path(entry.path))
+    except OSError:
+        print(f"Error reading directory: {dir_path}")
+    return trc_files, sub_dirs
+
+
+def iter_trc_files(data_path:Path, recursive:bool=True):
+    """
+    Yield the .trc files of a directory as they are found, the subdirectories are scanned in parallel.
+    Args:
+        data_path (Path): Path to the directory containing .trc files.
+        recursive (bool): Also scan the subdirectories.
+    Yields:
+        Path: Path to a .trc file.
+    """
+    with ThreadPoolExecutor(max_workers=SCAN_WORKERS) as executor:
+        pending = {executor.submit(scan_directory, data_path)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                trc_files, sub_dirs = future.result()
+                if recursive:
+                    pending.update(executor.submit(scan_directory, sub_dir) for sub_dir in sub_dirs)
+                yield from trc_files